@@ -8,16 +8,24 @@ https://huggingface.co/turboderp/Qwama-0.5B-Instruct/blob/main/vocab_transplant.
 """
 
 import argparse
+import contextlib
+import gc
+import itertools
 import json
 import os
 import re
 import shutil
 import sys
+import numpy as np
 import torch
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List
 
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig, GenerationConfig
 
 import torch.nn as nn
 
@@ -41,8 +49,11 @@ def parse_arguments() -> argparse.Namespace:
                        help = "Trim the hidden state dimension (and the number of heads as a result)")
     parser.add_argument("--trim-intermediate-size", type = int,
                        help = "Trim the intermediate dimension of the MLP blocks")
+    parser.add_argument("--fast-load", action = "store_true",
+                       help = "Read only the donor's embedding tensors from its safetensors files, and never load "
+                            "the full model unless it is needed for trimming (or a float32 output with --use-cpu-only)")
     parser.add_argument("--use-cpu-only", action = "store_true",
-                       help = "Use CPU only for model loading and processing in float32")
+                       help = "Use CPU only for model loading and processing in float32 (and save the output model in float32)")
     parser.add_argument("--trust-remote-code", action = "store_true",
                        help = "Allow custom code execution when loading models with non-standard architectures")
     parser.add_argument("--patch-missing-bos", action = "store_true",
@@ -137,6 +148,110 @@ def load_model(path: str, trust_remote_code = False, use_cpu_only = False) -> Au
     except Exception as e:
         sys.exit(f"Failed to load model: {e}")
 
+def has_safetensors(path: str) -> bool:
+    """Check if a model directory contains its weights in safetensors format"""
+    return (os.path.exists(os.path.join(path, "model.safetensors.index.json"))
+            or os.path.exists(os.path.join(path, "model.safetensors")))
+
+def get_safetensors_weight_map(path: str) -> Dict[str, str]:
+    """Map each tensor name to the safetensors file (relative to `path`) that contains it"""
+    index_path = os.path.join(path, "model.safetensors.index.json")
+    model_path = os.path.join(path, "model.safetensors")
+    try:
+        if os.path.exists(index_path):
+            with open(index_path, "r", encoding = "utf-8") as f:
+                return json.load(f)["weight_map"]
+        if os.path.exists(model_path):
+            with safe_open(model_path, framework = "pt", device = "cpu") as f:
+                return {key: "model.safetensors" for key in f.keys()}
+    except Exception as e:
+        sys.exit(f"Error reading safetensors index from {path}: {e}")
+    sys.exit(f"Error: No safetensors files found in {path}")
+
+def load_safetensors_tensors(path: str, names: List[str]) -> Dict[str, torch.Tensor]:
+    """
+    Load only the named tensors from a model's safetensors file(s), without loading the model.
+    
+    Args:
+        path: Path to the model directory
+        names: The tensor names to load
+        
+    Returns:
+        Dictionary mapping each name to its (CPU) tensor
+    """
+    weight_map = get_safetensors_weight_map(path)
+    for name in names:
+        if name not in weight_map:
+            sys.exit(f"Error: Tensor '{name}' not found in safetensors files of {path}")
+
+    tensors = {}
+    try:
+        print(f"Loading {len(names)} tensors from '{path}'... ", end = "")
+        for filename in sorted({weight_map[name] for name in names}):
+            with safe_open(os.path.join(path, filename), framework = "pt", device = "cpu") as f:
+                for name in names:
+                    if weight_map[name] == filename:
+                        tensors[name] = f.get_tensor(name)
+        print("Done.")
+    except Exception as e:
+        sys.exit(f"Failed to load tensors: {e}")
+
+    return tensors
+
+def load_embedding_weights(path: str, config) -> Tuple[torch.Tensor, torch.Tensor, torch.dtype]:
+    """
+    Load only the input embeddings and output head from a model's safetensors file(s).
+    
+    Args:
+        path: Path to the model directory
+        config: The model configuration (used to check for tied embeddings)
+        
+    Returns:
+        Tuple of (input embeddings, output head, dtype) where the output head is the
+        input embeddings tensor itself if the model has tied embeddings
+    """
+    # NOTE: Treat a model without its own 'lm_head.weight' as tied (transformers ties by default if not configured)
+    weight_map = get_safetensors_weight_map(path)
+    if get_config_value(config, "tie_word_embeddings", False) or "lm_head.weight" not in weight_map:
+        tensors = load_safetensors_tensors(path, ["model.embed_tokens.weight"])
+        embed_tokens = lm_head = tensors["model.embed_tokens.weight"]
+    else:
+        tensors = load_safetensors_tensors(path, ["model.embed_tokens.weight", "lm_head.weight"])
+        embed_tokens, lm_head = tensors["model.embed_tokens.weight"], tensors["lm_head.weight"]
+    return embed_tokens, lm_head, embed_tokens.dtype
+
+def count_safetensors_parameters(path: str) -> Tuple[int, int, int]:
+    """
+    Count the total number of parameters in a model's safetensors file(s), without loading the model.
+    
+    Args:
+        path: Path to the model directory
+        
+    Returns:
+        Tuple of (total parameters, embedding and LM head parameters only,
+                 parameters excluding embeddings and LM head)
+    """
+    weight_map = get_safetensors_weight_map(path)
+    total_params = 0
+    embedding_params = 0
+    non_embedding_params = 0
+
+    for filename in sorted(set(weight_map.values())):
+        with safe_open(os.path.join(path, filename), framework = "pt", device = "cpu") as f:
+            for name in f.keys():
+                param_count = 1
+                for dim in f.get_slice(name).get_shape():
+                    param_count *= dim
+                total_params += param_count
+
+                # Separate embedding/LM head parameters from the rest
+                if any(skip_name in name for skip_name in ['embed_tokens', 'lm_head']):
+                    embedding_params += param_count
+                else:
+                    non_embedding_params += param_count
+
+    return total_params, embedding_params, non_embedding_params
+
 def count_model_parameters(model) -> Tuple[int, int, int]:
     """
     Count the total number of parameters in a model.
@@ -193,7 +308,7 @@ def set_config_value(config, key: str, value):
         if hasattr(config, "text_config") and hasattr(config.text_config, key):
             setattr(config.text_config, key, value)
 
-def process_automatic_token_overrides(target_tokenizer, donor_tokenizer, target_config, donor_config, existing_map = None):
+def process_automatic_token_overrides(target_tokenizer, donor_tokenizer, target_config, donor_config, existing_map = None) -> Dict[int, List[int]]:
     """
     Process automatic token overrides for special tokens.
     
@@ -204,7 +319,7 @@ def process_automatic_token_overrides(target_tokenizer, donor_tokenizer, target_
         donor_config: The donor model configuration
         
     Returns:
-        Dictionary mapping target token IDs to donor token IDs
+        Dictionary mapping target token IDs to lists of donor token IDs
     """
     override_map = existing_map.copy() if existing_map else {}
 
@@ -228,10 +343,10 @@ def process_automatic_token_overrides(target_tokenizer, donor_tokenizer, target_
                 if target_token_id not in override_map:
                     target_token = target_tokenizer.convert_ids_to_tokens(target_token_id)
                     donor_token = donor_tokenizer.convert_ids_to_tokens(donor_token_id)
-                    override_map[target_token_id] = torch.tensor([donor_token_id], dtype = torch.long)
+                    override_map[target_token_id] = [donor_token_id]
                     print(f"✔ {repr(token_attr)} : {target_token_id} {repr(target_token)} → [{donor_token_id}] {repr(donor_token)}")
                 else:
-                    print(f"✘ {repr(token_attr)} : {target_token_id} is already mapped to [{override_map[target_token_id].item()}]")
+                    print(f"✘ {repr(token_attr)} : {target_token_id} is already mapped to {override_map[target_token_id]}")
             else:
                 print(f"✘ {repr(token_attr)} : Not found for donor model")
         else:
@@ -239,7 +354,7 @@ def process_automatic_token_overrides(target_tokenizer, donor_tokenizer, target_
 
     return override_map
 
-def process_manual_token_overrides(target_tokenizer, donor_tokenizer, manual_overrides, existing_map = None):
+def process_manual_token_overrides(target_tokenizer, donor_tokenizer, manual_overrides, existing_map = None) -> Dict[int, List[int]]:
     """
     Process manual token overrides specified by the user.
     
@@ -250,7 +365,7 @@ def process_manual_token_overrides(target_tokenizer, donor_tokenizer, manual_ove
         existing_map: Existing override map to update (optional)
         
     Returns:
-        Updated dictionary mapping target token IDs to donor token IDs
+        Updated dictionary mapping target token IDs to lists of donor token IDs
     """
     override_map = existing_map.copy() if existing_map else {}
 
@@ -270,136 +385,300 @@ def process_manual_token_overrides(target_tokenizer, donor_tokenizer, manual_ove
             donor_tokens = donor_tokens.replace("\\n", chr(10))
 
         # Get the IDs from the token string
-        encoded = donor_tokenizer.encode(donor_tokens, add_special_tokens = False, return_tensors = "pt").flatten()
-        assert encoded.numel() != 0, f"Donor token '{donor_tokens}' for target ID {target_id} encodes to 0 tokens."
+        encoded = donor_tokenizer.encode(donor_tokens, add_special_tokens = False)
+        assert len(encoded) != 0, f"Donor token '{donor_tokens}' for target ID {target_id} encodes to 0 tokens."
 
         # Store the donor token IDs
         override_map[target_id] = encoded
 
-        print(f"✔ {target_id:6d} : {repr(target_token)} → {encoded.tolist()} {repr(donor_tokens)}")
+        print(f"✔ {target_id:6d} : {repr(target_token)} → {encoded} {repr(donor_tokens)}")
 
     return override_map
 
-def compute_front_loaded_mean(v, weighting_decay_factor = 0.5):
+def prepare_encodings(target_tokenizer, donor_tokenizer, used_vocab_size):
+    """
+    Decode every used target token and re-encode it with the donor tokenizer.
+    
+    Both steps are done as single batched calls so the (fast) tokenizers can do the work
+    in Rust, rather than making one Python round trip per token. Target tokens that decode
+    to the same string (eg: unused/reserved slots) are only encoded once.
+    
+    Args:
+        target_tokenizer: The target tokenizer
+        donor_tokenizer: The donor tokenizer
+        used_vocab_size: Number of tokens actually used in the target vocabulary
+        
+    Returns:
+        Tuple of (list of decoded target strings, list of donor token ID lists)
+    """
+    decoded_list = target_tokenizer.batch_decode([[idx] for idx in range(used_vocab_size)], decode_special_tokens = True)
+
+    # Group the target token IDs by their decoded string so each unique string is only encoded once
+    unique_map = defaultdict(list)
+    for idx, decoded in enumerate(decoded_list):
+        unique_map[decoded].append(idx)
+    unique_encodings = donor_tokenizer(list(unique_map), add_special_tokens = False)["input_ids"]
+
+    # Fan the encodings back out to every target token ID
+    encodings = [None] * used_vocab_size
+    for encoded, indices in zip(unique_encodings, unique_map.values()):
+        for idx in indices:
+            encodings[idx] = encoded
+
+    return decoded_list, encodings
+
+def flatten_encodings(encodings) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Computes the "front-loaded" exponentially-weighted mean with a weighting decay factor.
+    Flatten a list of token ID lists into a CSR-style pair of arrays.
+    
+    Args:
+        encodings: List of token ID lists
+        
+    Returns:
+        Tuple of (flat token IDs, offsets) where the IDs of `encodings[i]` are `flat_ids[offsets[i]:offsets[i+1]]`
+    """
+    lengths = np.fromiter((len(encoded) for encoded in encodings), dtype = np.int32, count = len(encodings))
+    offsets = np.zeros(len(encodings) + 1, dtype = np.int32)
+    np.cumsum(lengths, out = offsets[1:])
+    flat_ids = np.fromiter(itertools.chain.from_iterable(encodings), dtype = np.int32, count = int(offsets[-1]))
+    return flat_ids, offsets
+
+def bucketize_encodings(flat_ids, offsets):
+    """
+    Partition CSR-style encodings into single token and multi-token mappings.
+    
+    Args:
+        flat_ids: Flat token IDs (see `flatten_encodings`)
+        offsets: Offsets into `flat_ids` (see `flatten_encodings`)
+        
+    Returns:
+        Tuple of (single token targets, single token sources, multi-token targets,
+                 flat multi-token sources, offsets into the flat multi-token sources)
+    """
+    lengths = np.diff(offsets)
+    is_single = lengths == 1
+
+    single_tgt = np.flatnonzero(is_single).astype(np.int32)
+    single_src = flat_ids[offsets[:-1][is_single]]
+
+    multi_tgt = np.flatnonzero(~is_single).astype(np.int32)
+    multi_src = flat_ids[np.repeat(~is_single, lengths)]
+    multi_offsets = np.zeros(multi_tgt.size + 1, dtype = np.int32)
+    np.cumsum(lengths[~is_single], out = multi_offsets[1:])
+
+    return single_tgt, single_src, multi_tgt, multi_src, multi_offsets
+
+def get_index_dtype(size: int) -> torch.dtype:
+    """Get the smallest index dtype accepted by `index_select` and `index_add_` that can index `size` rows"""
+    return torch.int32 if size < 2**31 else torch.int64
+
+def indices_to_device(indices: np.ndarray, device, dtype = torch.long) -> torch.Tensor:
+    """
+    Convert a NumPy index array to an index tensor on the given device.
+    
+    For CUDA devices the indices are staged in pinned host memory so the transfer can be
+    done asynchronously (on the current stream) with `non_blocking = True`.
+    """
+    device = torch.device(device)
+    host_indices = torch.empty(indices.shape, dtype = dtype, pin_memory = device.type == "cuda")
+    host_indices.copy_(torch.from_numpy(indices))
+    return host_indices.to(device, non_blocking = True)
+
+def first_only_decay_powers(max_len, dtype, device):
+    """Weights 1, 0, 0, ... (weighting_decay_factor=0) with cumulative sums all 1"""
+    decay_powers = torch.zeros(max_len, dtype = dtype, device = device)
+    decay_powers[0] = 1
+    return decay_powers, torch.ones(max_len, dtype = dtype, device = device)
+
+def halving_decay_powers(max_len, dtype, device):
+    """Weights 1, 0.5, 0.25, ... (weighting_decay_factor=0.5) with cumulative sums 2 - 2^(1-n)"""
+    decay_powers = torch.ldexp(torch.ones(max_len, dtype = dtype, device = device), -torch.arange(max_len, device = device))
+    return decay_powers, 2 - decay_powers
+
+def uniform_decay_powers(max_len, dtype, device):
+    """Weights 1, 1, 1, ... (weighting_decay_factor=1) with cumulative sums 1, 2, 3, ..."""
+    return torch.ones(max_len, dtype = dtype, device = device), torch.arange(1, max_len + 1, dtype = dtype, device = device)
+
+# Specialized (closed form) weights for the common weighting decay factors
+DECAY_POWERS_SPECIALIZATIONS = {
+    0.0: first_only_decay_powers,
+    0.5: halving_decay_powers,
+    1.0: uniform_decay_powers,
+}
+
+def compute_decay_powers(weighting_decay_factor, max_len, dtype = torch.float32, device = None):
+    """
+    Precompute the geometric progression of weights used for the "front-loaded" means.
     
     Parameters:
-    - v: torch tensor with values
     - weighting_decay_factor: parameter in [0, 1] controlling how quickly weights decay for subsequent vectors
+    - max_len: the longest sequence the weights will be needed for
+    - dtype: dtype of the returned tensors
+    - device: device of the returned tensors
     
     Returns:
-    - Weighted average tensor
+    - Tuple of (weight for each position, cumulative sum of the weights for each position)
+    """
+    # Assert that weighting_decay_factor is in the valid range [0, 1]
+    assert 0 <= weighting_decay_factor <= 1, f"weighting_decay_factor must be in range [0, 1], got {weighting_decay_factor}"
+
+    # Use the closed form weights for the special cases
+    if weighting_decay_factor in DECAY_POWERS_SPECIALIZATIONS:
+        return DECAY_POWERS_SPECIALIZATIONS[weighting_decay_factor](max_len, dtype, device)
+
+    decay_powers = torch.pow(weighting_decay_factor, torch.arange(max_len, dtype = dtype, device = device))
+    return decay_powers, torch.cumsum(decay_powers, dim = 0)
+
+def compute_front_loaded_means(v, src, lengths, decay_powers, decay_cumsum):
+    """
+    Computes the "front-loaded" exponentially-weighted means with a weighting decay factor,
+    for many variable length sequences of rows of `v` at once.
+    
+    All the rows are gathered with a single `index_select` and the weighted sums are reduced
+    per sequence with a single `index_add_`. The denominators are looked up from the
+    precomputed cumulative sum of the weights. The weighting and reduction are always done
+    in float32, regardless of the dtype of `v`.
+    
+    Parameters:
+    - v: torch tensor with the values to gather rows from
+    - src: flat (int32 or int64) tensor of the row indices into `v` for all the sequences
+    - lengths: (int32 or int64) tensor with the length of each sequence in `src` (one per output row)
+      NOTE: No sequence may be longer than `decay_powers` (the caller sizes it from the longest sequence)
+    - decay_powers: weight for each position (see `compute_decay_powers`)
+    - decay_cumsum: cumulative sum of the weights for each position (see `compute_decay_powers`)
+    
+    Returns:
+    - Tensor (float32) of weighted averages with one row per entry in `lengths`
     
     Special cases:
     - weighting_decay_factor=0   : Returns only the first vector (maximum front-loading)
     - weighting_decay_factor=0.5 : Applies weights 1, 0.5, 0.25, 0.125, ... (earlier vectors have more influence)
     - weighting_decay_factor=1   : Returns the uniform arithmetic mean (no front-loading)
     """
-    # Assert that weighting_decay_factor is in the valid range [0, 1]
-    assert 0 <= weighting_decay_factor <= 1, f"weighting_decay_factor must be in range [0, 1], got {weighting_decay_factor}"
-
-    n = v.shape[0]
-
-    if n == 1 or weighting_decay_factor == 0:
-        return v[0]  # First (or only) vector only
-    elif weighting_decay_factor == 1:
-        return torch.mean(v, dim = 0)  # Arithmetic mean
-    else:
-        # Compute the weights using geometric progression
-        decay_powers = torch.tensor([weighting_decay_factor ** i for i in range(n)], device = v.device)
-        decay_powers = decay_powers.view(-1, *([1] * (v.dim() - 1)))
-        weighted_sum = torch.sum(decay_powers * v, dim = 0)
-        denominator = torch.sum(decay_powers)
-        return weighted_sum / denominator
-
-def transplant_tokens(model, donor_config, target_tokenizer, donor_tokenizer,
+    num_segments = lengths.numel()
+
+    # Find the segment and position within the segment of each row (using the same index dtype as `src`)
+    # NOTE: Passing `output_size` avoids a device-to-host sync to find the size of the result
+    seg_id = torch.repeat_interleave(torch.arange(num_segments, dtype = src.dtype, device = v.device), lengths, output_size = src.numel())
+    starts = torch.cumsum(lengths, dim = 0, dtype = src.dtype) - lengths
+    pos = torch.arange(src.numel(), dtype = src.dtype, device = v.device) - torch.repeat_interleave(starts, lengths, output_size = src.numel())
+    w = torch.index_select(decay_powers, 0, pos).to(dtype = torch.float32)
+
+    # Gather all the rows at once and reduce them into their segments (in float32)
+    rows = torch.index_select(v, 0, src).to(dtype = torch.float32) * w.unsqueeze(-1)
+    weighted_sum = torch.zeros((num_segments, v.shape[1]), dtype = torch.float32, device = v.device).index_add_(0, seg_id, rows)
+    denominator = torch.index_select(decay_cumsum, 0, lengths - 1).to(dtype = torch.float32)
+    return weighted_sum / denominator.unsqueeze(-1)
+
+def transplant_tokens(donor_embed_tokens, donor_lm_head, decoded_list, encodings,
                       override_map, vocab_size, used_vocab_size,
                       weighting_decay_factor, verbose = False):
     """
     Transplant token embeddings from donor model to target vocabulary.
     
     Args:
-        model: The donor model
-        donor_config: The donor model configuration
-        target_tokenizer: The target tokenizer
-        donor_tokenizer: The donor tokenizer
-        override_map: Dictionary mapping target token IDs to donor token IDs
+        donor_embed_tokens: The donor model's input embeddings
+        donor_lm_head: The donor model's output head (or the input embeddings tensor itself if tied)
+        decoded_list: List of decoded target token strings (see `prepare_encodings`)
+        encodings: List of donor token ID lists for each target token (see `prepare_encodings`)
+        override_map: Dictionary mapping target token IDs to lists of donor token IDs
         vocab_size: Total size of the target vocabulary
         used_vocab_size: Number of tokens actually used in the target vocabulary
         weighting_decay_factor: Factor for weighting multi-token mappings
         verbose: Whether to print detailed mapping information
         
     Returns:
-        Tuple of (new state dict, embedding statistics)
+        Tuple of (new input embeddings, new output head) both in float32 (to be downcast when saving)
     """
     # Get donor hidden size
-    donor_hidden_size = get_config_value(donor_config, "hidden_size")
+    donor_hidden_size = donor_embed_tokens.shape[1]
 
-    # Get donor embeddings
-    donor_embed_tokens = model.model.embed_tokens.weight
-    if get_config_value(donor_config, "tie_word_embeddings", False):
-        print("\nNOTE: Using an \"untied\" copy of 'embed_tokens.weight' as new 'lm_head.weight' tensor...\n")
-        donor_lm_head = model.model.embed_tokens.weight
-    else:
-        print("\nNOTE: Using actual 'lm_head.weight' tensor as donor not configured with 'tie_word_embeddings...\n")
-        donor_lm_head = model.lm_head.weight
-
-    # Initialize new embedding and head tensors with zeros
-    new_embed_tokens = torch.zeros(
-        (vocab_size, donor_hidden_size),
-        dtype = donor_embed_tokens.dtype,
-        device = donor_embed_tokens.device
-    )
-    new_lm_head = torch.zeros(
-        (vocab_size, donor_hidden_size),
-        dtype = donor_lm_head.dtype,
-        device = donor_lm_head.device
-    )
+    # Apply the overrides on top of a copy of the tokenizer's encodings
+    encodings = list(encodings)
+    for idx, encoded in override_map.items():
+        if idx < used_vocab_size:
+            encodings[idx] = encoded
 
-    # Track mapping statistics
-    mapping_counts = {}
-    lm_head_copy_count = 0
-    lm_head_mean_count = 0
-
-    # Configure progress display
-    iterator = range(used_vocab_size)
     if verbose:
         print("Transplanting tokens:")
-    else:
-        iterator = tqdm(iterator, desc = "Transplanting tokens", unit = "token")
+        for idx, encoded in enumerate(encodings):
+            print(f"- {idx:6d} : {repr(decoded_list[idx])} → {encoded}")
 
-    for idx in iterator:
-        decoded = target_tokenizer.decode([idx], decode_special_tokens = True)
-        if idx in override_map:
-            encoded = override_map[idx]
-        else:
-            encoded = donor_tokenizer.encode(decoded, add_special_tokens = False, return_tensors = "pt").flatten()
+    # Flatten and partition into single token copies and multi-token means for the lm_head
+    flat_ids, offsets = flatten_encodings(encodings)
+    single_tgt, single_src, multi_tgt, multi_src, multi_offsets = bucketize_encodings(flat_ids, offsets)
 
-        if verbose:
-            print(f"- {idx:6d} : {repr(decoded)} → {encoded.tolist()}")
+    # Track mapping statistics
+    mapping_counts = np.bincount(np.diff(offsets))
 
-        # Track mapping types
-        if encoded.numel() in mapping_counts:
-            mapping_counts[encoded.numel()] += 1
-        else:
-            mapping_counts[encoded.numel()] = 1
+    # Use 32-bit indices for the gathers where possible (NOTE: `index_copy_` only accepts int64 indices)
+    index_dtype = get_index_dtype(donor_embed_tokens.shape[0])
 
-        # Use only the final token of encoded sequence for input embeddings
-        new_embed_tokens[idx] = donor_embed_tokens[encoded[-1]]
+    # Initialize new embedding tensor with zeros (all the transplant work is done in float32)
+    new_embed_tokens = torch.zeros(
+        (vocab_size, donor_hidden_size),
+        dtype = torch.float32,
+        device = donor_embed_tokens.device
+    )
 
-        # Use a "front-loaded" exponentially-weighted mean for lm_head embeddings
-        if encoded.numel() == 1:
-            new_lm_head[idx] = donor_lm_head[encoded[0].item()]
-            lm_head_copy_count += 1
-        else:
-            head_embeddings = donor_lm_head[encoded.flatten()]
-            new_lm_head[idx] = compute_front_loaded_mean(head_embeddings, weighting_decay_factor)
-            lm_head_mean_count += 1
+    # Use only the final token of encoded sequence for input embeddings (gathered in one go)
+    last_ids = indices_to_device(flat_ids[offsets[1:] - 1], donor_embed_tokens.device, index_dtype)
+
+    # If tied, the single token lm_head rows are identical to the input embedding rows, so start from a copy of them
+    # NOTE: Only the multi-token rows then need to be overwritten with their means
+    tied = donor_lm_head is donor_embed_tokens
+    if tied:
+        new_embed_tokens[:used_vocab_size] = torch.index_select(donor_embed_tokens, 0, last_ids).to(dtype = torch.float32)
+        new_lm_head = new_embed_tokens.clone()
+    else:
+        new_lm_head = torch.zeros(
+            (vocab_size, donor_hidden_size),
+            dtype = torch.float32,
+            device = donor_lm_head.device
+        )
+
+    # On CUDA, run the multi-token means on a second stream so they overlap with the copies
+    use_cuda = donor_lm_head.device.type == "cuda"
+    if use_cuda:
+        multi_stream = torch.cuda.Stream(device = donor_lm_head.device)
+        multi_stream.wait_stream(torch.cuda.current_stream(donor_lm_head.device))
+
+    # Use a "front-loaded" exponentially-weighted mean for the multi-token lm_head rows (computed in one go)
+    if multi_tgt.size > 0:
+        with torch.cuda.stream(multi_stream) if use_cuda else contextlib.nullcontext():
+            multi_tgt_ids = indices_to_device(multi_tgt, donor_lm_head.device)
+            multi_src_ids = indices_to_device(multi_src, donor_lm_head.device, index_dtype)
+            multi_lengths = np.diff(multi_offsets)
+            decay_powers, decay_cumsum = compute_decay_powers(
+                weighting_decay_factor,
+                int(multi_lengths.max()),
+                device = donor_lm_head.device
+            )
+            multi_lengths = indices_to_device(multi_lengths, donor_lm_head.device, index_dtype)
+            head_means = compute_front_loaded_means(donor_lm_head, multi_src_ids, multi_lengths, decay_powers, decay_cumsum)
+            new_lm_head.index_copy_(0, multi_tgt_ids, head_means)
+    lm_head_mean_count = int(multi_tgt.size)
+
+    # If not tied, gather the input embeddings after the fork so they overlap with the multi-token means
+    if not tied:
+        new_embed_tokens[:used_vocab_size] = torch.index_select(donor_embed_tokens, 0, last_ids).to(dtype = torch.float32)
+
+    # Copy all the single token lm_head rows in one go (already done if tied)
+    if single_tgt.size > 0 and not tied:
+        single_tgt_ids = indices_to_device(single_tgt, donor_lm_head.device)
+        single_src_ids = indices_to_device(single_src, donor_lm_head.device, index_dtype)
+        new_lm_head.index_copy_(0, single_tgt_ids, torch.index_select(donor_lm_head, 0, single_src_ids).to(dtype = torch.float32))
+    lm_head_copy_count = int(single_tgt.size)
+
+    # Make the current stream wait for the multi-token means before the results are used
+    if use_cuda:
+        torch.cuda.current_stream(donor_lm_head.device).wait_stream(multi_stream)
 
     # Print statistics
     print("\nTransplant mappings:")
-    for count, occurrences in sorted(mapping_counts.items()):
+    for count, occurrences in enumerate(mapping_counts.tolist()):
+        if occurrences == 0:
+            continue
         mapping_label = f"{count} to 1"
         print(f"- {mapping_label:<8}: {occurrences} ({(occurrences/used_vocab_size*100):.2g}%)")
 
@@ -409,15 +688,7 @@ def transplant_tokens(model, donor_config, target_tokenizer, donor_tokenizer,
     print(f"- Means  : {lm_head_mean_count} ({(lm_head_mean_count/vocab_size*100):.2g}%)")
     print(f"- Zeros  : {lm_head_zeroed_count} ({(lm_head_zeroed_count/vocab_size*100):.2g}%)")
 
-    # Make a copy of the model's state_dict and get the type
-    new_state_dict = model.state_dict().copy()
-    old_dtype = model.model.embed_tokens.weight.dtype
-
-    # Update the state_dict with new embeddings
-    new_state_dict['model.embed_tokens.weight'] = new_embed_tokens.to(dtype = old_dtype)
-    new_state_dict['lm_head.weight'] = new_lm_head.to(dtype = old_dtype)
-
-    return new_state_dict
+    return new_embed_tokens, new_lm_head
 
 def trim_model_layers(model, state_dict, start_layer, end_layer):
     """
@@ -653,22 +924,28 @@ def patch_tokenizer_config_bos(output_dir):
     if os.path.exists(tokenizer_config_path):
         print(f"\nPatching BOS handling in '{tokenizer_config_path}'")
         try:
-            # Read the file as text without specifying encoding
-            with open(tokenizer_config_path, "r") as f:
-                config_text = f.read()
+            # Parse the file (NOTE: json keeps big integers like 'model_max_length' exact, unlike orjson)
+            with open(tokenizer_config_path, "r", encoding = "utf-8") as f:
+                config = json.load(f)
 
             # Make sure that add_bos_token is set to false
-            config_text = config_text.replace('"add_bos_token": true', '"add_bos_token": false')
+            if config.get("add_bos_token"):
+                config["add_bos_token"] = False
             print("- Updated 'add_bos_token' configuration.")
 
-            # Remove any use of bos_token from chat template
+            # Remove any use of bos_token from chat template (which may be a list of named templates)
             # NOTE: We can't (safely) set '"bos_token": null', but it shouldn't matter with these two patches...
-            config_text = config_text.replace("{{ bos_token }}", "").replace("{{bos_token}}", "")
+            chat_template = config.get("chat_template")
+            if isinstance(chat_template, str):
+                config["chat_template"] = chat_template.replace("{{ bos_token }}", "").replace("{{bos_token}}", "")
+            elif isinstance(chat_template, list):
+                for entry in chat_template:
+                    entry["template"] = entry["template"].replace("{{ bos_token }}", "").replace("{{bos_token}}", "")
             print("- Removed all references to 'bos_token' from Jinja chat template.")
 
-            # Write the modified text back without specifying encoding
-            with open(tokenizer_config_path, "w") as f:
-                f.write(config_text)
+            # Write the modified config back
+            with open(tokenizer_config_path, "w", encoding = "utf-8") as f:
+                f.write(json.dumps(config, indent = 2, ensure_ascii = False) + "\n")
         except Exception as e:
             print(f"Warning: Failed to patch tokenizer configuration: {e}")
 
@@ -679,17 +956,21 @@ def patch_config_dtype(output_dir):
     Args:
         output_dir: Path to the output directory containing the config.json and model files
     """
-    import json
-    from safetensors import safe_open
-
     config_path = os.path.join(output_dir, "config.json")
+    index_path = os.path.join(output_dir, "model.safetensors.index.json")
     model_path = os.path.join(output_dir, "model.safetensors")
 
+    # Use the shard containing embed_tokens if the model was saved sharded
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            weight_map = json.load(f)["weight_map"]
+        model_path = os.path.join(output_dir, weight_map.get("model.embed_tokens.weight", next(iter(weight_map.values()))))
+
     if not os.path.exists(config_path) or not os.path.exists(model_path):
         print(f"Warning: Could not find config.json or model.safetensors in {output_dir}")
         return
 
-    print(f"\nPatching 'torch_dtype' in '{config_path}' based on actual saved tensors")
+    print(f"\nPatching 'torch_dtype' and 'dtype' in '{config_path}' based on actual saved tensors")
 
     try:
         # Open the safetensors file and check the dtype of a tensor
@@ -710,9 +991,10 @@ def patch_config_dtype(output_dir):
         with open(config_path, "r") as f:
             config = json.load(f)
 
-        # Update the dtype
+        # Update the dtype (newer versions of transformers use 'dtype' instead of the legacy 'torch_dtype' key)
         config['torch_dtype'] = dtype_str
-        print(f"- Updated 'torch_dtype' to '{dtype_str}' based on actual tensor dtype")
+        config['dtype'] = dtype_str
+        print(f"- Updated 'torch_dtype' and 'dtype' to '{dtype_str}' based on actual tensor dtype")
 
         # Write the modified config back
         with open(config_path, "w") as f:
@@ -721,6 +1003,68 @@ def patch_config_dtype(output_dir):
     except Exception as e:
         print(f"Warning: Failed to patch config file: {e}")
 
+def save_patched_shards(donor_dir, output_dir, new_tensors):
+    """
+    Save the donor model's safetensors shards with some tensors replaced, without re-serializing the whole model.
+    
+    Shards that don't contain any of the new tensors are copied verbatim, and only the shards
+    that do are rewritten. Any new tensors the donor doesn't have (eg: 'lm_head.weight' for a
+    donor with tied embeddings) are added to the shard containing 'model.embed_tokens.weight'.
+    
+    Args:
+        donor_dir: Path to the donor model directory
+        output_dir: Path to the output directory
+        new_tensors: Dictionary mapping tensor names to their new values
+    """
+    weight_map = get_safetensors_weight_map(donor_dir)
+    index_path = os.path.join(donor_dir, "model.safetensors.index.json")
+
+    # Work out which shard each of the new tensors will be written to
+    new_weight_map = dict(weight_map)
+    for name in new_tensors:
+        if name not in new_weight_map:
+            new_weight_map[name] = weight_map["model.embed_tokens.weight"]
+    patched_filenames = {new_weight_map[name] for name in new_tensors}
+
+    size_change = 0
+    params_change = 0
+    for filename in tqdm(sorted(set(new_weight_map.values())), desc = "Saving shards", unit = "shard"):
+        donor_path = os.path.join(donor_dir, filename)
+        output_path = os.path.join(output_dir, filename)
+        if filename not in patched_filenames:
+            shutil.copy(donor_path, output_path)
+            continue
+
+        with safe_open(donor_path, framework = "pt", device = "cpu") as f:
+            metadata = f.metadata() or {"format": "pt"}
+            tensors = {name: f.get_tensor(name) for name in f.keys()}
+
+        # Replace (or add) the new tensors, keeping the dtype of the tensors already in the shards
+        default_tensor = tensors.get("model.embed_tokens.weight", next(iter(tensors.values())))
+        for name, tensor in new_tensors.items():
+            if new_weight_map[name] == filename:
+                old_tensor = tensors.get(name)
+                dtype = old_tensor.dtype if old_tensor is not None else default_tensor.dtype
+                new_tensor = tensor.to(device = "cpu", dtype = dtype).contiguous()
+                size_change += new_tensor.nbytes - (old_tensor.nbytes if old_tensor is not None else 0)
+                params_change += new_tensor.numel() - (old_tensor.numel() if old_tensor is not None else 0)
+                tensors[name] = new_tensor
+
+        save_file(tensors, output_path, metadata = metadata)
+        del tensors
+
+    # Write the updated index if the donor model is sharded
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding = "utf-8") as f:
+            index = json.load(f)
+        if "total_size" in index.get("metadata", {}):
+            index["metadata"]["total_size"] += size_change
+        if "total_parameters" in index.get("metadata", {}):
+            index["metadata"]["total_parameters"] += params_change
+        index["weight_map"] = dict(sorted(new_weight_map.items()))
+        with open(os.path.join(output_dir, "model.safetensors.index.json"), "w", encoding = "utf-8") as f:
+            json.dump(index, f, indent = 2)
+
 def debug_model_tensors(model, state_dict):
     """
     Print detailed information about model parameters and state dict tensors
@@ -787,15 +1131,42 @@ def main():
     donor_tokenizer = load_tokenizer(args.donor_dir, args.trust_remote_code)
     target_tokenizer = load_tokenizer(args.target_dir, args.trust_remote_code)
 
-    # Load the donor model
-    model = load_model(args.donor_dir, args.trust_remote_code, args.use_cpu_only)
+    # If we aren't trimming then only the embeddings change, so we can just copy and patch the donor's shards
+    # NOTE: Not used with --use-cpu-only, as the whole output model is then saved in float32
+    # NOTE: Only used if the embeddings are stored as 'model.embed_tokens.weight', else we fall back to `save_pretrained`
+    patch_shards = (not (args.trim_layers or args.trim_hidden_size or args.trim_intermediate_size)
+                    and not args.use_cpu_only
+                    and has_safetensors(args.donor_dir)
+                    and "model.embed_tokens.weight" in get_safetensors_weight_map(args.donor_dir))
+
+    if args.fast_load and not has_safetensors(args.donor_dir):
+        sys.exit(f"Error: --fast-load requires the donor model to be saved in safetensors format: {args.donor_dir}")
 
     # The config file counts the all tokens, but we also need to know how many are used for the loop
     used_target_vocab_size = max(target_tokenizer.vocab.values()) + 1
     unused_target_vocab_size = target_vocab_size - used_target_vocab_size
 
+    # Decode all target tokens and re-encode them with the donor tokenizer in a background thread while loading
+    # NOTE: The fast tokenizers release the GIL, so this overlaps with the (mostly I/O bound) model loading
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        print("Encoding target vocabulary with donor tokenizer in the background...")
+        encodings_future = executor.submit(prepare_encodings, target_tokenizer, donor_tokenizer, used_target_vocab_size)
+
+        # Load the donor model (or just its embedding tensors for the transplant)
+        if args.fast_load:
+            donor_embed_tokens, donor_lm_head, donor_dtype = load_embedding_weights(args.donor_dir, donor_config)
+            donor_tied_embeddings = donor_lm_head is donor_embed_tokens
+        else:
+            model = load_model(args.donor_dir, args.trust_remote_code, args.use_cpu_only)
+
+        # Wait for the encodings before anything else uses the tokenizers
+        decoded_list, encodings = encodings_future.result()
+
     # Count parameters in donor model
-    donor_total_params, donor_embedding_params, donor_non_embedding_params = count_model_parameters(model)
+    if args.fast_load:
+        donor_total_params, donor_embedding_params, donor_non_embedding_params = count_safetensors_parameters(args.donor_dir)
+    else:
+        donor_total_params, donor_embedding_params, donor_non_embedding_params = count_model_parameters(model)
     donor_total_params_b = donor_total_params / 1e9
     donor_embedding_params_b = donor_embedding_params / 1e9
     donor_non_embedding_params_b = donor_non_embedding_params / 1e9
@@ -820,64 +1191,119 @@ def main():
     # Process manual token overrides
     override_map = process_manual_token_overrides(target_tokenizer, donor_tokenizer, args.override, override_map)
 
+    # Get donor embeddings
+    if args.fast_load:
+        device = "cpu" if args.use_cpu_only or not torch.cuda.is_available() else "cuda"
+        dtype = torch.float32 if args.use_cpu_only else donor_dtype
+        donor_embed_tokens = donor_embed_tokens.to(device = device, dtype = dtype)
+        if donor_tied_embeddings:
+            donor_lm_head = donor_embed_tokens
+        else:
+            donor_lm_head = donor_lm_head.to(device = device, dtype = dtype)
+    else:
+        donor_embed_tokens = model.model.embed_tokens.weight.detach()
+        donor_lm_head = donor_embed_tokens if donor_tied_embeddings else model.lm_head.weight.detach()
+
+        # Free the donor model's transformer body if it won't be needed for saving (best-effort)
+        if patch_shards:
+            for name in ["layers", "norm", "rotary_emb"]:
+                if hasattr(model.model, name):
+                    delattr(model.model, name)
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+    if donor_tied_embeddings:
+        print("\nNOTE: Using an \"untied\" copy of 'embed_tokens.weight' as new 'lm_head.weight' tensor...\n")
+    else:
+        print("\nNOTE: Using actual 'lm_head.weight' tensor as donor not configured with 'tie_word_embeddings...\n")
+
     # Transplant tokens from donor model to target vocabulary
-    new_state_dict = transplant_tokens(
-        model = model,
-        donor_config = donor_config,
-        target_tokenizer = target_tokenizer,
-        donor_tokenizer = donor_tokenizer,
+    new_embed_tokens, new_lm_head = transplant_tokens(
+        donor_embed_tokens = donor_embed_tokens,
+        donor_lm_head = donor_lm_head,
+        decoded_list = decoded_list,
+        encodings = encodings,
         override_map = override_map,
         vocab_size = target_vocab_size,
         used_vocab_size = used_target_vocab_size,
         weighting_decay_factor = args.weighting_decay_factor,
         verbose = args.verbose
     )
+    del donor_embed_tokens, donor_lm_head
 
-    # Trim layers if requested
-    if args.trim_layers:
-        start_layer, end_layer = map(int, args.trim_layers.split('-'))
-        model, new_state_dict = trim_model_layers(model, new_state_dict, start_layer, end_layer)
+    # Load the full donor model now that the transplant is done (but only if we need it)
+    if args.fast_load:
+        if patch_shards:
+            model = None
+        else:
+            model = load_model(args.donor_dir, args.trust_remote_code, args.use_cpu_only)
 
-    # Trim hidden size if requested
-    if args.trim_hidden_size:
-        model, new_state_dict = trim_model_hidden_size(model, new_state_dict, args.trim_hidden_size)
+    # The output config (only the config itself is loaded if we never loaded the model)
+    config = model.config if model is not None else AutoConfig.from_pretrained(args.donor_dir, trust_remote_code = args.trust_remote_code)
 
-    # Trim intermediate size if requested
-    if args.trim_intermediate_size:
-        model, new_state_dict = trim_model_intermediate_size(model, new_state_dict, args.trim_intermediate_size)
+    if not patch_shards:
+        # Get the model's state_dict (already a new dict, and only two of its entries get replaced) and the type
+        new_state_dict = model.state_dict()
+        old_dtype = model.model.embed_tokens.weight.dtype
+        old_device = model.model.embed_tokens.weight.device
+
+        # Update the state_dict with new embeddings
+        new_state_dict['model.embed_tokens.weight'] = new_embed_tokens.to(device = old_device, dtype = old_dtype)
+        new_state_dict['lm_head.weight'] = new_lm_head.to(device = old_device, dtype = old_dtype)
+        del new_embed_tokens, new_lm_head
+
+        # Trim layers if requested
+        if args.trim_layers:
+            start_layer, end_layer = map(int, args.trim_layers.split('-'))
+            model, new_state_dict = trim_model_layers(model, new_state_dict, start_layer, end_layer)
+
+        # Trim hidden size if requested
+        if args.trim_hidden_size:
+            model, new_state_dict = trim_model_hidden_size(model, new_state_dict, args.trim_hidden_size)
+
+        # Trim intermediate size if requested
+        if args.trim_intermediate_size:
+            model, new_state_dict = trim_model_intermediate_size(model, new_state_dict, args.trim_intermediate_size)
 
     # Update model architecture
-    model.model.embed_tokens.num_embeddings = target_vocab_size
-    model.lm_head.out_features = target_vocab_size
+    if not patch_shards:
+        model.model.embed_tokens.num_embeddings = target_vocab_size
+        model.lm_head.out_features = target_vocab_size
 
     # Update model config
-    set_config_value(model.config, 'vocab_size', target_vocab_size)
-    set_config_value(model.config, 'bos_token_id', target_tokenizer.bos_token_id)
-    set_config_value(model.config, 'eos_token_id', target_tokenizer.eos_token_id)
+    set_config_value(config, 'vocab_size', target_vocab_size)
+    set_config_value(config, 'bos_token_id', target_tokenizer.bos_token_id)
+    set_config_value(config, 'eos_token_id', target_tokenizer.eos_token_id)
 
     # Update the config's pad_token_id if it exists
-    if has_config_value(model.config, 'pad_token_id'):
+    if has_config_value(config, 'pad_token_id'):
         if target_tokenizer.pad_token_id is not None:
-            set_config_value(model.config, 'pad_token_id', target_tokenizer.pad_token_id)
+            set_config_value(config, 'pad_token_id', target_tokenizer.pad_token_id)
         else:
-            set_config_value(model.config, 'pad_token_id', target_tokenizer.eos_token_id)  # Default to EOS if no PAD to copy
+            set_config_value(config, 'pad_token_id', target_tokenizer.eos_token_id)  # Default to EOS if no PAD to copy
 
     # Set the config's tie_word_embeddings to False if it exists
-    if has_config_value(model.config, 'tie_word_embeddings'):
-        set_config_value(model.config, 'tie_word_embeddings', False)
+    if has_config_value(config, 'tie_word_embeddings'):
+        set_config_value(config, 'tie_word_embeddings', False)
 
     # Re-initialize the model with the updated configuration
     # NOTE: This seems to be more robust that just altering the model and state dict parameters
-    model = type(model)(model.config)
-
-    output_num_layers = get_config_value(model.config, 'num_hidden_layers')
-    output_tied_embeddings = get_config_value(model.config, "tie_word_embeddings", False)
-    output_hidden_size = get_config_value(model.config, "hidden_size")
-    output_num_heads = get_config_value(model.config, "num_attention_heads")
-    output_intermediate_size = get_config_value(model.config, "intermediate_size")
-
-    # Count parameters in output model
-    output_total_params, output_embedding_params, output_non_embedding_params = count_model_parameters(model)
+    if not patch_shards:
+        model = type(model)(config)
+
+    output_num_layers = get_config_value(config, 'num_hidden_layers')
+    output_tied_embeddings = get_config_value(config, "tie_word_embeddings", False)
+    output_hidden_size = get_config_value(config, "hidden_size")
+    output_num_heads = get_config_value(config, "num_attention_heads")
+    output_intermediate_size = get_config_value(config, "intermediate_size")
+
+    # Count parameters in output model (only the untied embeddings differ from the donor if patching its shards)
+    if patch_shards:
+        output_embedding_params = 2 * target_vocab_size * output_hidden_size
+        output_non_embedding_params = donor_non_embedding_params
+        output_total_params = output_embedding_params + output_non_embedding_params
+    else:
+        output_total_params, output_embedding_params, output_non_embedding_params = count_model_parameters(model)
     output_total_params_b = output_total_params / 1e9
     output_embedding_params_b = output_embedding_params / 1e9
     output_non_embedding_params_b = output_non_embedding_params / 1e9
@@ -895,9 +1321,28 @@ def main():
 
     # debug_model_tensors(model, new_state_dict)
 
+    # Make sure all the (asynchronous) transplant work has finished before saving
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
     # Save final model and tokenizer
     print(f"\nSaving model and tokenizer to '{args.output_dir}' folder")
-    model.save_pretrained(args.output_dir, state_dict = new_state_dict, safe_serialization = True)
+    if patch_shards:
+        config.save_pretrained(args.output_dir)
+        GenerationConfig.from_model_config(config).save_pretrained(args.output_dir)
+
+        # Copy any custom modelling code, as `config.save_pretrained` only copies the configuration module
+        if args.trust_remote_code:
+            for filename in sorted(os.listdir(args.donor_dir)):
+                if filename.endswith(".py"):
+                    shutil.copy(os.path.join(args.donor_dir, filename), os.path.join(args.output_dir, filename))
+
+        save_patched_shards(args.donor_dir, args.output_dir, {
+            'model.embed_tokens.weight': new_embed_tokens,
+            'lm_head.weight': new_lm_head
+        })
+    else:
+        model.save_pretrained(args.output_dir, state_dict = new_state_dict, safe_serialization = True)
     target_tokenizer.save_pretrained(args.output_dir)
 
     # Patch the stupid `torch_dtype` bug in the config file where it always saves as float32 regardless of the actual type...